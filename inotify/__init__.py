@@ -48,7 +48,8 @@ max_user_watches = _read_procfs_value('max_user_watches')
 
 from . import _inotify as inotify
 from .in_constants import constants, event_properties, watch_properties, decode_mask
-from .watcher import Watcher, AutoWatcher, Threshold, NoFilesException
+from .watcher import Watcher, AutoWatcher, Threshold, NoFilesException, \
+        QueueOverflowException
 from .pathwatcher import PathWatcher
 from .pathresolver import InvalidPathError, SymlinkLoopError, \
         ConcurrentFilesystemModificationError, FileNotFoundError, NotADirectoryError
@@ -14,16 +14,28 @@
  */
 
 #include <Python.h>
+#include <structmember.h>
 #include <alloca.h>
 #include <sys/inotify.h>
 #include <stdint.h>
 #include <sys/ioctl.h>
 #include <unistd.h>
+#include <limits.h>
+#include <errno.h>
+#include <poll.h>
 
-/* This should be at least large enough to hold a single
- * inotify_event, otherwise crashes can occur. */
+/* The largest possible inotify event. The kernel never returns a partial
+ * event, and a read into a buffer smaller than the next event fails with
+ * EINVAL, so read buffers must be at least this large. */
+#define EVENT_SIZE_MAX (sizeof(struct inotify_event) + NAME_MAX + 1)
+
+/* Size of the buffer used by read() if no buffer is passed in. */
 #define READ_BUF_SIZE 64*1024
 
+/* read() keeps picking up events that arrive while it is reading, until
+ * this many bytes have been read in total. */
+#define DRAIN_MAX 1024*1024
+
 /* for older pythons */
 #ifndef Py_TYPE
 	#define Py_TYPE(ob) (((PyObject*)(ob))->ob_type)
@@ -46,13 +58,14 @@
 static PyObject *init(PyObject *self, PyObject *args)
 {
 	PyObject *ret = NULL;
+	int flags = 0;
 	int fd = -1;
 
-	 if (!PyArg_ParseTuple(args, ":init"))
+	 if (!PyArg_ParseTuple(args, "|i:init", &flags))
 		goto bail;
 
 	Py_BEGIN_ALLOW_THREADS
-	fd = inotify_init();
+	fd = inotify_init1(flags);
 	Py_END_ALLOW_THREADS
 
 	if (fd == -1) {
@@ -78,10 +91,14 @@ done:
 
 PyDoc_STRVAR(
 	init_doc,
-	"init() -> fd\n"
+	"init(flags=0) -> fd\n"
 	"\n"
 	"Initialise an inotify instance.\n"
-	"Return a file descriptor associated with a new inotify event queue.");
+	"Return a file descriptor associated with a new inotify event queue.\n"
+	"\n"
+	"        flags: IN_NONBLOCK and/or IN_CLOEXEC\n"
+	"\n"
+	"read() works on both blocking and nonblocking file descriptors.");
 
 static PyObject *add_watch(PyObject *self, PyObject *args)
 {
@@ -132,6 +149,103 @@ PyDoc_STRVAR(
 	"Return a unique numeric watch descriptor for the inotify instance\n"
 	"mapped by the file descriptor.");
 
+struct watch_request {
+	const char *path;
+	uint32_t mask;
+	int wd;
+	int err;
+};
+
+static PyObject *add_watches(PyObject *self, PyObject *args)
+{
+	struct watch_request *reqs = NULL;
+	PyObject *seq = NULL, *items = NULL, *ret = NULL;
+	Py_ssize_t i, n;
+	int fd;
+
+	if (!PyArg_ParseTuple(args, "iO:add_watches", &fd, &seq))
+		goto bail;
+
+	/* Take a private copy of the sequence, so it cannot be changed by
+	 * another thread while the GIL is released. */
+	items = PySequence_Tuple(seq);
+	if (items == NULL)
+		goto bail;
+
+	n = PyTuple_GET_SIZE(items);
+	reqs = PyMem_New(struct watch_request, n > 0 ? n : 1);
+	if (reqs == NULL) {
+		PyErr_NoMemory();
+		goto bail;
+	}
+
+	/* The path strings stay valid as long as items holds on to the
+	 * (immutable) tuples, so all watches can be added without the GIL. */
+	for (i = 0; i < n; i++) {
+		PyObject *item = PyTuple_GET_ITEM(items, i);
+
+		if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+			PyErr_Format(PyExc_TypeError,
+				     "add_watches() expects (path, mask) tuples, "
+				     "got %R at index %zd", item, i);
+			goto bail;
+		}
+		if (!PyArg_ParseTuple(item, "sI:add_watches", &reqs[i].path,
+				      &reqs[i].mask))
+			goto bail;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	for (i = 0; i < n; i++) {
+		reqs[i].wd = inotify_add_watch(fd, reqs[i].path, reqs[i].mask);
+		reqs[i].err = reqs[i].wd == -1 ? errno : 0;
+	}
+	Py_END_ALLOW_THREADS
+
+	ret = PyList_New(n);
+	if (ret == NULL)
+		goto bail;
+
+	for (i = 0; i < n; i++) {
+		PyObject *obj;
+
+		if (reqs[i].wd == -1)
+			obj = PyObject_CallFunction(PyExc_OSError, "iss",
+						    reqs[i].err,
+						    strerror(reqs[i].err),
+						    reqs[i].path);
+		else
+			obj = PyLong_FromLong(reqs[i].wd);
+		if (obj == NULL)
+			goto bail;
+		PyList_SET_ITEM(ret, i, obj);
+	}
+
+	goto done;
+
+bail:
+	Py_CLEAR(ret);
+
+done:
+	PyMem_Free(reqs);
+	Py_XDECREF(items);
+	return ret;
+}
+
+PyDoc_STRVAR(
+	add_watches_doc,
+	"add_watches(fd, [(path, mask), ...]) -> [wd, ...]\n"
+	"\n"
+	"Add or modify several watches at once, like calling add_watch()\n"
+	"for each (path, mask) pair.\n"
+	"\n"
+	"        fd: file descriptor returned by init()\n"
+	"        watches: sequence of (path, mask) tuples\n"
+	"\n"
+	"Return a list with a watch descriptor for each pair. If a watch\n"
+	"could not be added, its entry is an OSError instance instead; the\n"
+	"remaining watches are still added.");
+
 static PyObject *remove_watch(PyObject *self, PyObject *args)
 {
 	uint32_t wd;
@@ -249,6 +363,24 @@ PyDoc_STRVAR(
 
 static char doc[] = "Low-level inotify interface wrappers.";
 
+/* Define BUILTIN_MASK, the union of all inotify flags, and EXTENSION_BIT,
+ * the lowest bit above them. Python-inotify defines its own flags starting
+ * from EXTENSION_BIT. */
+static void define_masks(PyObject *mod)
+{
+	uint32_t builtin = 0;
+	uint64_t extension;
+	int i;
+
+	for (i = 0; bit_names[i].bit; i++)
+		builtin |= bit_names[i].bit;
+
+	extension = (uint64_t) 1 << (32 - __builtin_clz(builtin));
+
+	PyModule_AddObject(mod, "BUILTIN_MASK", PyLong_FromUnsignedLong(builtin));
+	PyModule_AddObject(mod, "EXTENSION_BIT", PyLong_FromUnsignedLongLong(extension));
+}
+
 static void define_const(PyObject *dict, const char *name, uint32_t val)
 {
 	PyObject *pyval = PyLong_FromUnsignedLong(val);
@@ -264,6 +396,13 @@ bail:
 	Py_XDECREF(pyval);
 }
 
+/* Flags for init(). in_constants.py keeps these out of the event flags. */
+static void define_init_flags(PyObject *dict)
+{
+	define_const(dict, "IN_NONBLOCK", IN_NONBLOCK);
+	define_const(dict, "IN_CLOEXEC", IN_CLOEXEC);
+}
+
 static void define_consts(PyObject *dict)
 {
 	define_const(dict, "IN_ACCESS", IN_ACCESS);
@@ -295,8 +434,8 @@ static void define_consts(PyObject *dict)
 	define_const(dict, "IN_ALL_EVENTS", IN_ALL_EVENTS);
 }
 
-// the event struct is not really doing anything that couldn't be done with a
-// python named tuple, it should probably be replaced.
+// The raw inotify event. This type can be subclassed, the subclass
+// instances can be created directly from the read buffer by read_dispatch().
 struct event {
 	PyObject_HEAD
 	PyObject *wd;
@@ -305,53 +444,63 @@ struct event {
 	PyObject *name;
 };
 
-static PyObject *event_wd(PyObject *self, void *x)
-{
-	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->wd);
-	return evt->wd;
-}
-
-static PyObject *event_mask(PyObject *self, void *x)
-{
-	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->mask);
-	return evt->mask;
-}
-
-static PyObject *event_cookie(PyObject *self, void *x)
-{
-	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->cookie);
-	return evt->cookie;
-}
-
-static PyObject *event_name(PyObject *self, void *x)
-{
-	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->name);
-	return evt->name;
-}
-
-static struct PyGetSetDef event_getsets[] = {
-	{"wd", event_wd, NULL,
+static PyMemberDef event_members[] = {
+	{"wd", T_OBJECT, offsetof(struct event, wd), READONLY,
 	 "watch descriptor"},
-	{"mask", event_mask, NULL,
+	{"mask", T_OBJECT, offsetof(struct event, mask), READONLY,
 	 "event mask"},
-	{"cookie", event_cookie, NULL,
+	{"cookie", T_OBJECT, offsetof(struct event, cookie), READONLY,
 	 "rename cookie, if rename-related event"},
-	{"name", event_name, NULL,
+	{"name", T_OBJECT, offsetof(struct event, name), READONLY,
 	 "file name"},
 	{NULL}
 };
 
 PyDoc_STRVAR(
 	event_doc,
-	"event: Structure describing an inotify event.");
+	"event(wd, mask, cookie=None, name=None)\n"
+	"\n"
+	"Structure describing an inotify event.");
 
-static PyObject *event_new(PyTypeObject *t, PyObject *a, PyObject *k)
+static PyObject *event_new(PyTypeObject *t, PyObject *args, PyObject *kwds)
 {
-	return (*t->tp_alloc)(t, 0);
+	static char *kwlist[] = {"wd", "mask", "cookie", "name", NULL};
+	PyObject *cookie = Py_None, *name = Py_None;
+	struct event *evt;
+	uint32_t mask;
+	int wd;
+
+	/* Parse wd and mask as C integers, so the fields always hold the
+	 * same types as for events read from the kernel. */
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "iI|OO:event", kwlist,
+									 &wd, &mask, &cookie, &name))
+		return NULL;
+
+	if (cookie == Py_None)
+		Py_INCREF(cookie);
+	else if ((cookie = PyNumber_Index(cookie)) == NULL)
+		return NULL;
+
+	evt = (struct event *) (*t->tp_alloc)(t, 0);
+	if (evt == NULL)
+		goto bail;
+
+	evt->wd = PyLong_FromLong(wd);
+	if (evt->wd == NULL)
+		goto bail;
+	evt->mask = PyLong_FromUnsignedLong(mask);
+	if (evt->mask == NULL)
+		goto bail;
+	evt->cookie = cookie;
+	Py_INCREF(name);
+	evt->name = name;
+
+	return (PyObject *) evt;
+
+bail:
+	Py_XDECREF(evt);
+	Py_DECREF(cookie);
+	return NULL;
 }
 
 static void event_dealloc(struct event *evt)
@@ -367,15 +516,19 @@ static void event_dealloc(struct event *evt)
 static PyObject *event_repr(struct event *evt)
 {
 	int wd = PyLong_AsLong(evt->wd);
-	uint32_t cookie = evt->cookie == Py_None ? 0 : PyLong_AsLong(evt->cookie);
+	uint32_t cookie = evt->cookie == Py_None ? 0 : PyLong_AsUnsignedLongMask(evt->cookie);
+	uint32_t mask = PyLong_AsUnsignedLongMask(evt->mask);
 	PyObject *ret = NULL, *pymasks = NULL, *pymask = NULL;
 	PyObject *join = NULL;
 
+	if (PyErr_Occurred())
+		goto bail;
+
 	join = PyUnicode_FromString("|");
 	if (join == NULL)
 		goto bail;
 
-	pymasks = decode_mask(PyLong_AsLong(evt->mask));
+	pymasks = decode_mask(mask);
 	if (pymasks == NULL)
 		goto bail;
 
@@ -454,8 +607,8 @@ static PyTypeObject event_type = {
 	0,                         /* tp_iter */
 	0,                         /* tp_iternext */
 	0,                         /* tp_methods */
-	0,                         /* tp_members */
-	event_getsets,      /* tp_getset */
+	event_members,             /* tp_members */
+	0,                         /* tp_getset */
 	0,                         /* tp_base */
 	0,                         /* tp_dict */
 	0,                         /* tp_descr_get */
@@ -466,42 +619,344 @@ static PyTypeObject event_type = {
 	event_new,          /* tp_new */
 };
 	
-static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
+// A descriptor that tests a bit in the mask attribute of its instance. This
+// does the same as a property, but without calling into python code for every
+// access.
+struct maskflag {
+	PyObject_HEAD
+	PyObject *bit;
+	PyObject *doc;
+};
+
+static PyObject *mask_str = NULL;
+
+static PyObject *maskflag_new(PyTypeObject *t, PyObject *args, PyObject *kwds)
 {
-	static char buffer[READ_BUF_SIZE];
-	PyObject *ctor_args = NULL;
-	PyObject *ret = NULL;
-	int block = 1;
-	int readable = 0;
-	int pos, read_total, ioctl_retval;
-	int fd;
+	static char *kwlist[] = {"bit", "doc", NULL};
+	struct maskflag *flag;
+	PyObject *bit, *doc = Py_None;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|O:maskflag", kwlist, &bit, &doc))
+		return NULL;
+
+	flag = (struct maskflag *) (*t->tp_alloc)(t, 0);
+	if (flag == NULL)
+		return NULL;
+
+	Py_INCREF(bit);
+	flag->bit = bit;
+	Py_INCREF(doc);
+	flag->doc = doc;
+
+	return (PyObject *) flag;
+}
+
+static void maskflag_dealloc(struct maskflag *flag)
+{
+	Py_XDECREF(flag->bit);
+	Py_XDECREF(flag->doc);
+
+	(Py_TYPE(flag)->tp_free)(flag);
+}
+
+static PyObject *maskflag_get(struct maskflag *flag, PyObject *obj, PyObject *type)
+{
+	PyObject *mask, *ret;
+
+	if (obj == NULL || obj == Py_None) {
+		Py_INCREF(flag);
+		return (PyObject *) flag;
+	}
+
+	mask = PyObject_GetAttr(obj, mask_str);
+	if (mask == NULL)
+		return NULL;
+
+	ret = PyNumber_And(mask, flag->bit);
+	Py_DECREF(mask);
+
+	return ret;
+}
+
+static PyMemberDef maskflag_members[] = {
+	{"bit", T_OBJECT, offsetof(struct maskflag, bit), READONLY,
+	 "the bit or bits to test"},
+	{"__doc__", T_OBJECT, offsetof(struct maskflag, doc), READONLY},
+	{NULL}
+};
+
+PyDoc_STRVAR(
+	maskflag_doc,
+	"maskflag(bit, doc=None)\n"
+	"\n"
+	"Descriptor that returns instance.mask & bit when accessed on an\n"
+	"instance. Use it as a read only property for a flag in an event mask.");
+
+static PyTypeObject maskflag_type = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"_inotify.maskflag",             /*tp_name*/
+	sizeof(struct maskflag), /*tp_basicsize*/
+	0,                         /*tp_itemsize*/
+	(destructor)maskflag_dealloc, /*tp_dealloc*/
+	0,                         /*tp_print*/
+	0,                         /*tp_getattr*/
+	0,                         /*tp_setattr*/
+	0,                         /*tp_compare*/
+	0,                         /*tp_repr*/
+	0,                         /*tp_as_number*/
+	0,                         /*tp_as_sequence*/
+	0,                         /*tp_as_mapping*/
+	0,                         /*tp_hash */
+	0,                         /*tp_call*/
+	0,                         /*tp_str*/
+	0,                         /*tp_getattro*/
+	0,                         /*tp_setattro*/
+	0,                         /*tp_as_buffer*/
+	Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+	maskflag_doc,              /* tp_doc */
+	0,                         /* tp_traverse */
+	0,                         /* tp_clear */
+	0,                         /* tp_richcompare */
+	0,                         /* tp_weaklistoffset */
+	0,                         /* tp_iter */
+	0,                         /* tp_iternext */
+	0,                         /* tp_methods */
+	maskflag_members,          /* tp_members */
+	0,                         /* tp_getset */
+	0,                         /* tp_base */
+	0,                         /* tp_dict */
+	(descrgetfunc)maskflag_get, /* tp_descr_get */
+	0,                         /* tp_descr_set */
+	0,                         /* tp_dictoffset */
+	0,                         /* tp_init */
+	0,                         /* tp_alloc */
+	maskflag_new,              /* tp_new */
+};
+
+static PyObject *event_cookie_obj(struct inotify_event *in)
+{
+	if (in->mask & IN_MOVE)
+		return PyLong_FromLong(in->cookie);
+	Py_RETURN_NONE;
+}
+
+static PyObject *event_name_obj(struct inotify_event *in)
+{
+	if (in->len)
+		return PyUnicode_FromString(in->name);
+	Py_RETURN_NONE;
+}
+
+/* Set the fields of evt from in, replacing any previous values */
+static int fill_event(struct event *evt, struct inotify_event *in)
+{
+	PyObject *old[4] = {evt->wd, evt->mask, evt->cookie, evt->name};
+	int i;
+
+	evt->wd = PyLong_FromLong(in->wd);
+	evt->mask = PyLong_FromLong(in->mask);
+	evt->cookie = event_cookie_obj(in);
+	evt->name = event_name_obj(in);
+
+	for (i = 0; i < 4; i++)
+		Py_XDECREF(old[i]);
+
+	if (!evt->wd || !evt->mask || !evt->cookie || !evt->name)
+		return -1;
 
-	static char *kwlist[] = {"fd", "block", NULL};
+	return 0;
+}
+
+static PyObject *make_event(struct inotify_event *in, void *ctx)
+{
+	struct event *evt;
+
+	evt = (struct event *) (*event_type.tp_alloc)(&event_type, 0);
+	if (evt == NULL)
+		return NULL;
+
+	if (fill_event(evt, in) == -1) {
+		Py_DECREF(evt);
+		return NULL;
+	}
+
+	return (PyObject *) evt;
+}
+
+static PyObject *make_tuple(struct inotify_event *in, void *ctx)
+{
+	PyObject *items[4];
+	PyObject *ret;
+	int i;
+
+	items[0] = PyLong_FromLong(in->wd);
+	items[1] = PyLong_FromLong(in->mask);
+	items[2] = event_cookie_obj(in);
+	items[3] = event_name_obj(in);
+
+	ret = PyTuple_New(4);
+
+	if (!ret || !items[0] || !items[1] || !items[2] || !items[3]) {
+		Py_XDECREF(ret);
+		for (i = 0; i < 4; i++)
+			Py_XDECREF(items[i]);
+		return NULL;
+	}
+
+	for (i = 0; i < 4; i++)
+		PyTuple_SET_ITEM(ret, i, items[i]);
+
+	return ret;
+}
 
+struct dispatch_ctx {
+	PyObject *factory;
+	PyObject *watches;
+	uint32_t mask;
+	PyObject *matched;
+	PyObject *pool;
+};
+
+static PyObject *watch_str = NULL;
+
+/* Create an instance of the event subtype type directly, reusing an
+ * instance from pool if there is one. */
+static PyObject *make_subtype_event(PyTypeObject *type, PyObject *pool,
+									struct inotify_event *in, PyObject *watches)
+{
+	struct event *evt = NULL;
+	PyObject *watch;
+	Py_ssize_t n;
+
+	if (pool != NULL && (n = PyList_GET_SIZE(pool)) > 0) {
+		evt = (struct event *) PyList_GET_ITEM(pool, n - 1);
+		Py_INCREF(evt);
+		if (PyList_SetSlice(pool, n - 1, n, NULL) == -1) {
+			Py_DECREF(evt);
+			return NULL;
+		}
+		if (Py_TYPE(evt) != type)
+			Py_CLEAR(evt);
+	}
+
+	if (evt == NULL) {
+		evt = (struct event *) (*type->tp_alloc)(type, 0);
+		if (evt == NULL)
+			return NULL;
+	}
+
+	if (fill_event(evt, in) == -1)
+		goto bail;
+
+	/* borrowed reference */
+	watch = PyDict_GetItem(watches, evt->wd);
+	if (watch == NULL)
+		watch = Py_None;
+
+	if (PyObject_SetAttr((PyObject *) evt, watch_str, watch) == -1)
+		goto bail;
+
+	return (PyObject *) evt;
+
+bail:
+	Py_DECREF(evt);
+	return NULL;
+}
+
+/* Call factory(raw, watch) for an event, where raw is the event tuple and
+ * watch is looked up by wd in the watches dict. If factory is a subtype of
+ * event it is instantiated directly instead. The result is also added to the
+ * matched list if the event mask matches. */
+static PyObject *make_dispatched(struct inotify_event *in, void *arg)
+{
+	struct dispatch_ctx *ctx = (struct dispatch_ctx *) arg;
+	PyObject *raw, *watch, *obj;
+
+	if (PyType_Check(ctx->factory) &&
+			PyType_IsSubtype((PyTypeObject *) ctx->factory, &event_type)) {
+		obj = make_subtype_event((PyTypeObject *) ctx->factory, ctx->pool,
+								 in, ctx->watches);
+	} else {
+		raw = make_tuple(in, NULL);
+		if (raw == NULL)
+			return NULL;
+
+		/* borrowed reference */
+		watch = PyDict_GetItem(ctx->watches, PyTuple_GET_ITEM(raw, 0));
+		if (watch == NULL)
+			watch = Py_None;
+
+		obj = PyObject_CallFunctionObjArgs(ctx->factory, raw, watch, NULL);
+		Py_DECREF(raw);
+	}
+
+	if (obj != NULL && in->mask & ctx->mask) {
+		if (PyList_Append(ctx->matched, obj) == -1)
+			Py_CLEAR(obj);
+	}
+
+	return obj;
+}
+
+typedef PyObject *(*event_builder)(struct inotify_event *in, void *ctx);
+
+/* Argument format strings for keyword only and boolean arguments */
 #if PY_MAJOR_VERSION >= 3 && PY_MINOR_VERSION >= 3
-	const char *format = "i|$p:read";
+	#define KWONLY "$"
+	#define BOOL_ARG "p"
 #else
-	const char* format = "i|i:read";
+	#define KWONLY ""
+	#define BOOL_ARG "i"
+#endif
+
+/* Keyword only arguments are not supported by older pythons, so check the
+ * number of positional arguments by hand. */
+static int check_positional(PyObject *args, const char *name, Py_ssize_t max)
+{
+#if !(PY_MAJOR_VERSION >= 3 && PY_MINOR_VERSION >= 3)
 	Py_ssize_t argc = PyTuple_Size(args);
 	if (argc == -1)
-		goto bail;
-	if (argc > 1) {
-		PyErr_Format(PyExc_TypeError, "read() takes exactly 1 positional argument but %i were given", argc);
-		goto bail;
+		return -1;
+	if (argc > max) {
+		PyErr_Format(PyExc_TypeError, "%s() takes exactly %i positional argument(s) but %i were given",
+					 name, (int) max, (int) argc);
+		return -1;
 	}
 #endif
+	return 0;
+}
 
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, format, kwlist, &fd, &block))
-		goto bail;
+/* The implementation of the read functions. build creates the python object
+ * for a single event, and is passed ctx. */
+static PyObject *read_common(int fd, int block, PyObject *bufobj,
+							 event_builder build, void *ctx)
+{
+	static char static_buffer[READ_BUF_SIZE];
+	char *buffer = static_buffer;
+	int bufsize = READ_BUF_SIZE;
+	Py_buffer view;
+	PyObject *ret = NULL;
+	int readable = 0, more = 0;
+	int pos, read_total, ioctl_retval;
+
+	view.obj = NULL;
+
+	if (bufobj != Py_None) {
+		if (PyObject_GetBuffer(bufobj, &view, PyBUF_WRITABLE) == -1)
+			goto bail;
+		if (view.len < (Py_ssize_t) EVENT_SIZE_MAX) {
+			PyErr_Format(PyExc_ValueError, "read buffer must be at least %i bytes",
+						 (int) EVENT_SIZE_MAX);
+			goto bail;
+		}
+		buffer = view.buf;
+		bufsize = min(view.len, INT_MAX);
+	}
 
 	ret = PyList_New(0);
 	if (ret == NULL)
 		goto bail;
 	
-	ctor_args = PyTuple_New(0);
-	if (ctor_args == NULL)
-		goto bail;
-
 	Py_BEGIN_ALLOW_THREADS;
 	ioctl_retval = ioctl(fd, FIONREAD, &readable);
 	Py_END_ALLOW_THREADS;
@@ -520,12 +975,39 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 
 	do {
 		int nread, size;
-		int toread = min(readable - read_total, READ_BUF_SIZE - pos);
+		int toread = readable - read_total;
+
+		/* If nothing was readable we are blocking, in which case we take
+		 * whatever fits once events arrive. */
+		if (toread <= 0 || toread > bufsize - pos)
+			toread = bufsize - pos;
 
+	readagain:
 		Py_BEGIN_ALLOW_THREADS
 		nread = read(fd, buffer + pos, toread);
 		Py_END_ALLOW_THREADS;
 
+		if (nread == -1 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+			struct pollfd pfd = {fd, POLLIN, 0};
+			int pollret;
+
+			/* Nothing more to read on a nonblocking fd */
+			if (!block || read_total > 0)
+				break;
+
+			Py_BEGIN_ALLOW_THREADS
+			pollret = poll(&pfd, 1, -1);
+			Py_END_ALLOW_THREADS;
+
+			if (pollret == -1 && errno != EINTR) {
+				PyErr_SetFromErrno(PyExc_OSError);
+				goto bail;
+			}
+			if (PyErr_CheckSignals() == -1)
+				goto bail;
+			goto readagain;
+		}
+
 		if (nread == -1) {
 			PyErr_SetFromErrno(PyExc_OSError);
 			goto bail;
@@ -540,7 +1022,7 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 			// order these comparisons so there won't be an overflow if in->len is very large
 			if (size - pos < INE_SIZE || size - pos - INE_SIZE < in->len) {
 				if (pos == 0 ||
-						in->len > READ_BUF_SIZE - INE_SIZE ||
+						in->len > bufsize - INE_SIZE ||
 						in->len >= readable - (read_total - nread + pos + INE_SIZE)) {
 					// This is not supposed to happen, unless we are reading
 					// garbage. Maybe the fd wasn't an inotify fd?
@@ -555,55 +1037,41 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 				goto nextread;
 			}
 			
-			struct event *evt;
-			PyObject *obj;
-
-			obj = PyObject_CallObject((PyObject *) &event_type, ctor_args);
+			PyObject *obj = build(in, ctx);
 
 			if (obj == NULL)
 				goto bail;
 
-			evt = (struct event *) obj;
-
-			evt->wd = PyLong_FromLong(in->wd);
-			evt->mask = PyLong_FromLong(in->mask);
-			if (in->mask & IN_MOVE)
-				evt->cookie = PyLong_FromLong(in->cookie);
-			else {
-				Py_INCREF(Py_None);
-				evt->cookie = Py_None;
-			}
-			if (in->len)
-				evt->name = PyUnicode_FromString(in->name);
-			else {
-				Py_INCREF(Py_None);
-				evt->name = Py_None;
+			if (PyList_Append(ret, obj) == -1) {
+				Py_DECREF(obj);
+				goto bail;
 			}
 
-			if (!evt->wd || !evt->mask || !evt->cookie || !evt->name)
-				goto mybail;
-
-			if (PyList_Append(ret, obj) == -1)
-				goto mybail;
-
 			pos += sizeof(struct inotify_event) + in->len;
 			Py_DECREF(obj);
+		}
+
+		pos = 0;
+
+	nextread:
+		if (read_total < readable)
 			continue;
 
-		mybail:
-			Py_CLEAR(evt->wd);
-			Py_CLEAR(evt->mask);
-			Py_CLEAR(evt->cookie);
-			Py_CLEAR(evt->name);
-			Py_DECREF(obj);
+		/* Drain events that were queued while we were reading, so a
+		 * burst is returned from a single call. */
+		if (read_total >= DRAIN_MAX)
+			break;
 
+		Py_BEGIN_ALLOW_THREADS;
+		ioctl_retval = ioctl(fd, FIONREAD, &more);
+		Py_END_ALLOW_THREADS;
+
+		if (ioctl_retval < 0) {
+			PyErr_SetFromErrno(PyExc_OSError);
 			goto bail;
 		}
 
-		pos = 0;
-
-	nextread:
-		;
+		readable = read_total + more;
 
 	} while (read_total < readable);
 	
@@ -613,30 +1081,138 @@ bail:
 	Py_CLEAR(ret);
 	
 done:
-	Py_XDECREF(ctor_args);
+	if (view.obj != NULL)
+		PyBuffer_Release(&view);
 
 	return ret;
 }
 
+static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	static char *kwlist[] = {"fd", "block", "buffer", NULL};
+	PyObject *bufobj = Py_None;
+	int block = 1;
+	int fd;
+
+	if (check_positional(args, "read", 1) == -1)
+		return NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "i|" KWONLY BOOL_ARG "O:read", kwlist,
+									 &fd, &block, &bufobj))
+		return NULL;
+
+	return read_common(fd, block, bufobj, make_event, NULL);
+}
+
+static PyObject *read_batch(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	static char *kwlist[] = {"fd", "block", "buffer", NULL};
+	PyObject *bufobj = Py_None;
+	int block = 1;
+	int fd;
+
+	if (check_positional(args, "read_batch", 1) == -1)
+		return NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "i|" KWONLY BOOL_ARG "O:read_batch", kwlist,
+									 &fd, &block, &bufobj))
+		return NULL;
+
+	return read_common(fd, block, bufobj, make_tuple, NULL);
+}
+
+static PyObject *read_dispatch(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	static char *kwlist[] = {"fd", "factory", "watches", "mask", "pool", "block", "buffer", NULL};
+	struct dispatch_ctx ctx = {NULL, NULL, 0, NULL, NULL};
+	PyObject *bufobj = Py_None;
+	PyObject *events;
+	int block = 1;
+	int fd;
+
+	if (check_positional(args, "read_dispatch", 3) == -1)
+		return NULL;
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "iOO!|" KWONLY "IO" BOOL_ARG "O:read_dispatch", kwlist,
+									 &fd, &ctx.factory, &PyDict_Type, &ctx.watches,
+									 &ctx.mask, &ctx.pool, &block, &bufobj))
+		return NULL;
+
+	if (ctx.pool == Py_None) {
+		ctx.pool = NULL;
+	} else if (ctx.pool != NULL && !PyList_Check(ctx.pool)) {
+		PyErr_SetString(PyExc_TypeError, "pool must be a list or None");
+		return NULL;
+	}
+
+	ctx.matched = PyList_New(0);
+	if (ctx.matched == NULL)
+		return NULL;
+
+	events = read_common(fd, block, bufobj, make_dispatched, &ctx);
+	if (events == NULL) {
+		Py_DECREF(ctx.matched);
+		return NULL;
+	}
+
+	return Py_BuildValue("(NN)", events, ctx.matched);
+}
+
 PyDoc_STRVAR(
 	read_doc,
-	"read(fd, *, block=True) -> list_of_events\n"
+	"read(fd, *, block=True, buffer=None) -> list_of_events\n"
 	"\n"
 	"Read inotify events from a file descriptor.\n"
 	"\n"
 	"        fd: file descriptor returned by init()\n"
 	"        block: If true, block if no events are available immediately.\n"
+	"        buffer: A writable buffer of at least EVENT_SIZE_MAX bytes to\n"
+	"            read into. It can be reused between calls. If None, a static\n"
+	"            buffer is used.\n"
 	"\n"
 	"Return a list of event objects. read() will always return as many events as "
-	"are available for reading at the moment the call to read() is made. \n"
+	"are available for reading at the moment the call to read() is made, and\n"
+	"also returns events that are queued while it is reading.\n"
 	"\n");
 
+PyDoc_STRVAR(
+	read_batch_doc,
+	"read_batch(fd, *, block=True, buffer=None) -> list_of_tuples\n"
+	"\n"
+	"Read inotify events from a file descriptor, like read(), but return\n"
+	"each event as a (wd, mask, cookie, name) tuple instead of an event\n"
+	"object. This is cheaper if many events are read.\n");
+
+PyDoc_STRVAR(
+	read_dispatch_doc,
+	"read_dispatch(fd, factory, watches, *, mask=0, pool=None, block=True,\n"
+	"              buffer=None) -> (list_of_events, list_of_matched_events)\n"
+	"\n"
+	"Read inotify events from a file descriptor like read_batch(), and call\n"
+	"factory(raw, watch) for each of them to create the returned events.\n"
+	"\n"
+	"        factory: callable that creates an event\n"
+	"        watches: dict from watch descriptor to watch. watch is None for\n"
+	"            watch descriptors that are not in the dict.\n"
+	"        mask: events whose mask has any of these bits set are also\n"
+	"            returned in the second list.\n"
+	"        pool: list of factory instances that can be reused.\n"
+	"\n"
+	"raw is the (wd, mask, cookie, name) tuple as returned by read_batch().\n"
+	"\n"
+	"If factory is a subclass of event, its instances are created and filled\n"
+	"in directly (or taken from pool) and their watch attribute is set,\n"
+	"without calling factory.\n");
+
 
 static PyMethodDef methods[] = {
 	{"init", init, METH_VARARGS, init_doc},
 	{"add_watch", add_watch, METH_VARARGS, add_watch_doc},
+	{"add_watches", add_watches, METH_VARARGS, add_watches_doc},
 	{"remove_watch", remove_watch, METH_VARARGS, remove_watch_doc},
 	{"read", (PyCFunction) read_events, METH_VARARGS | METH_KEYWORDS, read_doc},
+	{"read_batch", (PyCFunction) read_batch, METH_VARARGS | METH_KEYWORDS, read_batch_doc},
+	{"read_dispatch", (PyCFunction) read_dispatch, METH_VARARGS | METH_KEYWORDS, read_dispatch_doc},
 	{"decode_mask", pydecode_mask, METH_VARARGS, decode_mask_doc},
 	{NULL},
 };
@@ -652,12 +1228,36 @@ PyMODINIT_FUNC PyInit__inotify(void)
 	if (PyType_Ready(&event_type) == -1)
 		return NULL;
 
+	if (PyType_Ready(&maskflag_type) == -1)
+		return NULL;
+
+	mask_str = PyUnicode_InternFromString("mask");
+	if (mask_str == NULL)
+		return NULL;
+
+	watch_str = PyUnicode_InternFromString("watch");
+	if (watch_str == NULL)
+		return NULL;
+
 	mod = PyModule_Create(&moduledef);
+	if (mod == NULL)
+		return NULL;
+
+	Py_INCREF(&event_type);
+	PyModule_AddObject(mod, "event", (PyObject *) &event_type);
+
+	Py_INCREF(&maskflag_type);
+	PyModule_AddObject(mod, "maskflag", (PyObject *) &maskflag_type);
 
 	dict = PyModule_GetDict(mod);
 	
-	if (dict)
+	if (dict) {
 		define_consts(dict);
+		define_init_flags(dict);
+	}
+
+	PyModule_AddIntConstant(mod, "EVENT_SIZE_MAX", EVENT_SIZE_MAX);
+	define_masks(mod);
 
 	return mod;
 }
@@ -670,12 +1270,36 @@ void init_inotify(void)
 	if (PyType_Ready(&event_type) == -1)
 		return;
 
+	if (PyType_Ready(&maskflag_type) == -1)
+		return;
+
+	mask_str = PyString_InternFromString("mask");
+	if (mask_str == NULL)
+		return;
+
+	watch_str = PyString_InternFromString("watch");
+	if (watch_str == NULL)
+		return;
+
 	mod = Py_InitModule3("_inotify", methods, doc);
+	if (mod == NULL)
+		return;
+
+	Py_INCREF(&event_type);
+	PyModule_AddObject(mod, "event", (PyObject *) &event_type);
+
+	Py_INCREF(&maskflag_type);
+	PyModule_AddObject(mod, "maskflag", (PyObject *) &maskflag_type);
 
 	dict = PyModule_GetDict(mod);
 	
-	if (dict)
+	if (dict) {
 		define_consts(dict);
+		define_init_flags(dict);
+	}
+
+	PyModule_AddIntConstant(mod, "EVENT_SIZE_MAX", EVENT_SIZE_MAX);
+	define_masks(mod);
 
 	return;
 }
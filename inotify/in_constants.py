@@ -11,18 +11,18 @@
 # modified under the terms of any version of the GNU Lesser General Public 
 # License greater than 2.1. 
 
-import functools, operator
 from . import _inotify
 
-constants = {k: v for k,v in _inotify.__dict__.items() if k.startswith('IN_')}
+# IN_NONBLOCK and IN_CLOEXEC are flags for init(), not for watches or events.
+_init_flags = ('IN_NONBLOCK', 'IN_CLOEXEC')
+constants = {k: v for k,v in _inotify.__dict__.items()
+             if k.startswith('IN_') and k not in _init_flags}
 
 
 # These constants are not part of the linux inotify api, they are
 # added by this module for use in PathWatcher.
-inotify_builtin_constants = functools.reduce(operator.or_, constants.values())
-IN_PATH_MOVED_TO = 1
-while IN_PATH_MOVED_TO <= inotify_builtin_constants:
-    IN_PATH_MOVED_TO <<= 1
+inotify_builtin_constants = _inotify.BUILTIN_MASK
+IN_PATH_MOVED_TO = _inotify.EXTENSION_BIT
 IN_PATH_MOVED_FROM = IN_PATH_MOVED_TO << 1
 IN_PATH_CREATE = IN_PATH_MOVED_TO << 2
 IN_PATH_DELETE = IN_PATH_MOVED_TO << 3
@@ -86,5 +86,19 @@ watch_properties.update(_inotify_properties)
 
 combined_masks = set('IN_ALL_EVENTS IN_MOVE IN_CLOSE IN_PATH_MOVED IN_PATH_CHANGED'.split())
 def decode_mask(mask):
-    return [name for name, m in constants.items() if not name in combined_masks and m & mask]
+    return list(_decode_mask(mask))
+
+# Only a limited number of distinct masks occur in practice, so cache the
+# decoded names. The cache is simply emptied if it grows too large.
+_decoded_masks = {}
+def _decode_mask(mask):
+    try:
+        return _decoded_masks[mask]
+    except KeyError:
+        pass
+    if len(_decoded_masks) >= 1024:
+        _decoded_masks.clear()
+    names = tuple(name for name, m in constants.items() if not name in combined_masks and m & mask)
+    _decoded_masks[mask] = names
+    return names
 
@@ -43,6 +43,11 @@ _root = PosixPath('/')
 _parentdir = PosixPath('..')
 
 
+def _tail(path):
+    '''Return path without its first component'''
+    return PosixPath(*path.parts[1:])
+
+
 def resolve_path(path):
     '''Resolve the symlinks in path, yielding all filesystem locations that are traversed.
 
@@ -91,7 +96,7 @@ def resolve_symlink(location, link_contents, active_links, known_links, linkcoun
     while True:
         if link_contents.is_absolute():
             location = _root
-            link_contents = link_contents.relative()
+            link_contents = link_contents.relative_to(_root)
 
         yield location, link_contents
         if link_contents == _curdir:
@@ -106,15 +111,15 @@ def resolve_symlink(location, link_contents, active_links, known_links, linkcoun
             # although a path that requires us to do this is probably a bug
             # somewhere.
             if all(p in ('/', '..') for p in location.parts):
-                location = location['..']
+                location = location / '..'
             else:
-                location = location.parent()
+                location = location.parent
             # Strip the first part of link_contents off
-            link_contents = link_contents.parts[1:]
+            link_contents = _tail(link_contents)
             continue
 
         try:
-            nextpath = location[link_contents.parts[0]]
+            nextpath = location / link_contents.parts[0]
             newlink = PosixPath(os.readlink(str(nextpath)))
         except OSError as e:
             if e.errno == errno.EINVAL:
@@ -125,7 +130,7 @@ def resolve_symlink(location, link_contents, active_links, known_links, linkcoun
                 # possible, but keeping the number of system calls at one per
                 # loop makes reasoning about race conditions easier.
                 location = nextpath
-                link_contents = link_contents.parts[1:]
+                link_contents = _tail(link_contents)
                 continue
             if e.errno == errno.ENOENT:
                 # The entry does not exist
@@ -156,7 +161,7 @@ def resolve_symlink(location, link_contents, active_links, known_links, linkcoun
         if nextpath in active_links:
             raise SymlinkLoopError(nextpath)
 
-        link_contents = link_contents.parts[1:]
+        link_contents = _tail(link_contents)
         # We have not yet attempted traversing this symlink during the
         # current call or any of its parents.
         if nextpath in known_links:
@@ -174,7 +179,7 @@ def resolve_symlink(location, link_contents, active_links, known_links, linkcoun
         for loc, link in resolve_symlink(location, newlink,
                           active_links.union((nextpath,)), known_links, linkcounter):
             if lastloc:
-                yield lastloc, lastlink[link_contents]
+                yield lastloc, lastlink / link_contents
             lastloc, lastlink = loc, link
         # The last yielded location is the final resolution of the symlink. The
         # last yielded link_contents is always '.' so we can ignore that.
@@ -220,11 +225,15 @@ def get_symlinkmax():
 
 class InvalidPathError (OSError):
     def __init__(self, msg, path, errno=None, *args):
+        # OSError.__init__ resets errno and friends, so call it first.
+        OSError.__init__(self, msg, *args)
         self.filename = path
         self.errno = errno
         if errno:
             self.strerror = os.strerror(errno)
-        OSError.__init__(self, msg, *args)
+
+    def __str__(self):
+        return self.args[0]
 
 class SymlinkLoopError (InvalidPathError):
     def __init__(self, path, *args):
@@ -247,7 +256,7 @@ if sys.version_info >= (3, 3):
     class FileNotFoundError (InvalidPathError, FileNotFoundError):
         def __init__(self, path, *args):
             InvalidPathError.__init__(self, fnf_msg.format(path), path,
-                                          errno=ENOENT, *args)
+                                          errno=errno.ENOENT, *args)
 
     class NotADirectoryError (InvalidPathError, NotADirectoryError):
         def __init__(self, path, *args):
@@ -27,18 +27,25 @@ import os, os.path, sys
 import errno
 import functools
 import operator
-from collections import namedtuple
+from collections import namedtuple, deque
 
 from pathlib import PosixPath
 
 from . import pathresolver
 from . import inotify as _inotify
-from .in_constants import constants, decode_mask, event_properties
-from .watcher import NoFilesException, _make_getter
+from .in_constants import constants, decode_mask, _decode_mask, event_properties
+from .watcher import NoFilesException, _add_flag_properties, _Waker
 from .pathresolver import SymlinkLoopError, ConcurrentFilesystemModificationError
 
 globals().update(constants)
 
+# Masks for the watches on path elements. The watch on a directory in the
+# path is interested in its own entries, a '..' element in the directory
+# itself.
+_ELEMENT_MASK = IN_UNMOUNT | IN_ONLYDIR | IN_EXCL_UNLINK | IN_IGNORED
+_SELF_MASK = IN_MOVE_SELF | IN_DELETE_SELF
+_ENTRY_MASK = IN_MOVE | IN_DELETE | IN_CREATE
+
 
 
 class Event(object):
@@ -62,6 +69,10 @@ class Event(object):
     events, the raw event is constructed and not from the underlying
     inotify system.
 
+    Each flag is also available as a property, e.g. event.path_changed.
+    In performance critical code, test the mask directly or use
+    event.has(IN_PATH_CHANGED).
+
     '''
 
     __slots__ = (
@@ -83,13 +94,17 @@ class Event(object):
     def mask_list(self):
         return decode_mask(self.mask)
 
+    def has(self, flags):
+        '''Return True if any of the given IN_* flags is set in the mask.'''
+        return bool(self.mask & flags)
+
     def __eq__(self, other):
         return isinstance(other, Event) and self.path == other.path and \
             self.mask == other.mask and self.cookie == other.cookie and \
             self.name == other.name and self.raw == other.raw
     
     def __repr__(self):
-        r = 'Event(path={}, mask={}'.format(repr(self.path), '|'.join(decode_mask(self.mask)))
+        r = 'Event(path={}, mask={}'.format(repr(self.path), '|'.join(_decode_mask(self.mask)))
         if self.cookie:
             r += ', cookie={}'.format(self.cookie)
         if self.name:
@@ -97,8 +112,7 @@ class Event(object):
         r += ')'
         return r
 
-for name, doc in event_properties.items():
-    setattr(Event, name, property(_make_getter(name, doc), doc=doc))
+_add_flag_properties(Event, event_properties)
 
 
 
@@ -109,12 +123,15 @@ class PathWatcher (object):
     generates a IN_PATH_CHANGED event.'''
 
     def __init__(self):
-        self.fd = _inotify.init()
+        self.fd = _inotify.init(_inotify.IN_NONBLOCK | _inotify.IN_CLOEXEC)
         self._watchdescriptors = {}
         self._paths = {}
         self._pending_watch_removes = 0
         self._reconnect = set()
-        self.events = []
+        self.events = deque()
+        # Reused by every read, see Watcher
+        self._readbuf = bytearray(64 * _inotify.EVENT_SIZE_MAX)
+        self._waker = _Waker(self.fd)
 
     def fileno(self):
         '''Return the file descriptor this watcher uses.  Useful for passing to select
@@ -180,9 +197,50 @@ class PathWatcher (object):
         '''Read a list of queued inotify events.
 
         block: If block is false, return only those events that can be
-        read immediately.
+        read immediately. A blocking read can be interrupted with wake(),
+        in which case an empty list is returned.
+        '''
+
+        if not self.events:
+            self._read_all(block)
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def pop_event(self, block=True):
+        '''Return the next event, reading more events from inotify if
+        needed. This is the same as read(), but returns the events one at a
+        time.
+
+        Return None if no event is available. That is the case if block is
+        false and no event can be read immediately, after wake(), but also
+        if the inotify events that were read do not produce any events for
+        the caller (such as the IN_IGNORED event for a removed watch), even
+        if block is true.
         '''
 
+        if not self.events:
+            self._read_all(block)
+        return self.events.popleft() if self.events else None
+
+    def wake(self):
+        '''Interrupt a blocking read() or pop_event() in another thread, or
+        end an iteration over this watcher, see Watcher.wake().'''
+
+        self._waker.wake()
+
+    def __iter__(self):
+        '''Iterate over events as they arrive, until wake() is called.'''
+        while True:
+            event = self.pop_event()
+            if event is not None:
+                yield event
+            elif self._waker.woken:
+                return
+
+    def _read_all(self, block):
+        '''Read events and append them to self.events'''
+
         # We call _inotify.read once at first. If we are expecting an
         # IN_IGNORE, we read it again until we get all pening
         # IN_IGNOREs. Secondly, if a
@@ -194,14 +252,14 @@ class PathWatcher (object):
         # again. Continue this loop until there are no more pending
         # IN_IGNORE events and no more _PathWatches awaiting
         # reconnection.
-        if self.events:
-            e, self.events = self.events, []
-            return e
         self._do_reconnect()
 
         if not len(self._watchdescriptors):
             raise NoFilesException("There are no files to watch")
 
+        if block and not self._waker.wait():
+            return
+
         lastevent = None
         do1 = True
         while do1 or self._pending_watch_removes > 0 or self._reconnect:
@@ -218,11 +276,9 @@ class PathWatcher (object):
                     self.events.append(e)
                     lastevent = e
             self._do_reconnect()
-        events, self.events = self.events, []
-        return events
 
     def _read_events(self, block):
-        for evt in _inotify.read(self.fd, block=block):
+        for evt in _inotify.read(self.fd, block=block, buffer=self._readbuf):
             if evt.wd == -1:
                 eventiter = self._handle_descriptorless_event(evt)
             else:
@@ -272,6 +328,7 @@ class PathWatcher (object):
         if self.fd is None:
             return
         os.close(self.fd)
+        self._waker.close()
         self._watchdescriptors.clear()
         self._paths.clear()
         self.fd = None
@@ -287,10 +344,22 @@ class _PathWatch (object):
     root = PosixPath('/')
     curdir = PosixPath('.')
     parentdir = PosixPath('..')
+
+    __slots__ = ('watcher',
+                 'path',
+                 '_pathstr',
+                 'mask',
+                 'links',
+                 'watch_complete',
+                 'cwd',
+                )
     
     def __init__(self, watcher, path, mask, remember_curdir=None):
         self.watcher = watcher
         self.path = path
+        # The path is fixed for the lifetime of the watch, and its string
+        # form goes into every event.
+        self._pathstr = str(path)
         self.mask = mask
         self.links = []
         # watch_complete values:
@@ -353,12 +422,11 @@ class _PathWatch (object):
 
     def add_path_element(self, path, rest, linkcount):
         assert rest != _PathWatch.curdir
-        mask = IN_UNMOUNT | IN_ONLYDIR | IN_EXCL_UNLINK | IN_IGNORED
         if rest.parts[0] == '..':
-            mask |= IN_MOVE_SELF | IN_DELETE_SELF
+            mask = _ELEMENT_MASK | _SELF_MASK
             name = None
         else:
-            mask |= IN_MOVE | IN_DELETE | IN_CREATE
+            mask = _ELEMENT_MASK | _ENTRY_MASK
             name = rest.parts[0]
         self.links.append(_Link(len(self.links), self, mask, path, name, rest, linkcount))
         
@@ -376,24 +444,24 @@ class _PathWatch (object):
                 if event.mask & IN_UNMOUNT:
                     self._register_reconnect()
             if event.mask & self.mask:
-                yield Event(event, str(self.path))
+                yield Event(event, self._pathstr)
         else:
             i = link.idx
-            if event.mask & (IN_MOVE | IN_DELETE | IN_CREATE):
+            if event.mask & _ENTRY_MASK:
                 # something happened to a directory entry
                 i += 1
             self._poplinks_from(i)
             if event.mask & (IN_MOVED_TO|IN_CREATE|IN_UNMOUNT):
                 self._register_reconnect()
-            if not event.mask & (IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED | IN_UNMOUNT):
-                name = str(PosixPath(link.path)[link.name])
+            if not event.mask & (_SELF_MASK | IN_IGNORED | IN_UNMOUNT):
+                name = str(PosixPath(link.path) / link.name)
             else:
                 name = link.path
             for m, t in _PathWatch._eventmap.items():
                 if event.mask & m:
                     evttype = t
             evttype |= (event.mask & IN_ISDIR)
-            yield Event(syntheticevent(mask=evttype, cookie=0, name=name, wd=event.wd), str(self.path))
+            yield Event(syntheticevent(mask=evttype, cookie=0, name=name, wd=event.wd), self._pathstr)
 
     def _poplinks_from(self, startidx):
         if startidx >= len(self.links):
@@ -428,7 +496,7 @@ class _PathWatch (object):
         self._poplinks_from(0)
 
     def __repr__(self):
-        return '<_PathWatch for {}>'.format(str(self.path))
+        return '<_PathWatch for {}>'.format(self._pathstr)
 
 
 class _Link (object):
@@ -455,21 +523,12 @@ class _Link (object):
         assert name is None or not '/' in name
         self.wd = watch.watcher._createwatch(path, self)
 
-    def handle_event(self, event):
-        # This method can be called after the _Link object has been .remove()'d
-        # if the underlying event arrived before the remove. So check if this
-        # instance is still active.
-        if self.wd is None:
-            return
-        for e in self.watch.handle_event(event, self):
-            yield e
-
     def remove(self):
         self.wd.remove_link(self)
         self.wd = None
 
     def printname(self):
-        return self.path+':'+str(PosixPath(self.rest).parts[0:1])
+        return self.path+':'+str(PosixPath(*PosixPath(self.rest).parts[0:1]))
 
     def __repr__(self):
         return '<_Link for {}>'.format(self.printname())
@@ -499,17 +558,22 @@ class _Descriptor (object):
         self.active = True
         # callbacks is indexed by name to improve speed and because we
         # can. Indexing by name and mask would be faster but would be more
-        # cumbersome to implement.
+        # cumbersome to implement. Links for the directory itself are under
+        # None. The lists are replaced rather than modified, so handle_event
+        # can iterate over them without copying even if the handlers register
+        # or remove links.
         self.callbacks = {}
 
     def register_link(self, link):
         assert self.active
         self.mask |= link.mask
-        self.callbacks.setdefault(link.name, []).append(link)
+        self.callbacks[link.name] = self.callbacks.get(link.name, []) + [link]
 
     def remove_link(self, link):
-        self.callbacks[link.name].remove(link)
-        if not self.callbacks[link.name]:
+        links = [l for l in self.callbacks[link.name] if l is not link]
+        if links:
+            self.callbacks[link.name] = links
+        else:
             del self.callbacks[link.name]
         if not self.callbacks:
             self.watcher._signal_empty_watch(self)
@@ -517,20 +581,27 @@ class _Descriptor (object):
     def handle_event(self, event):
         if event.mask & IN_IGNORED:
             self.active = False
-        # The list of callbacks can be modified from the handlers, so make a
-        # copy.
-        callbacks = list(self.callbacks.get(event.name, ()))
-        if event.name != None:
-            callbacks.extend(self.callbacks.get(None, ()))
-        for l in callbacks:
-            if not event.mask & (l.mask | IN_IGNORED):
-                continue
-            for e in l.handle_event(event):
+        mask = event.mask
+        for e in self._dispatch(event, mask, self.callbacks.get(event.name, ())):
+            yield e
+        if event.name is not None:
+            for e in self._dispatch(event, mask, self.callbacks.get(None, ())):
                 yield e
         if event.mask & IN_IGNORED:
             assert not self.callbacks
             assert not self.active
             self.watcher._removewatch(self)
+
+    def _dispatch(self, event, mask, links):
+        for l in links:
+            # A link can have been .remove()'d by the handler of a previous
+            # link in this loop, so check that it is still active.
+            if l.wd is None or not mask & (l.mask | IN_IGNORED):
+                continue
+            # Call the watch directly rather than through the link, to save a
+            # generator per event.
+            for e in l.watch.handle_event(event, l):
+                yield e
         
     def __repr__(self):
         names = ', '.join(set(l.printname() for lst in self.callbacks.values() for l in lst))
@@ -28,25 +28,27 @@ __author__ = "Jan Kanis <jan.code@jankanis.nl>"
 
 from . import constants
 from . import _inotify as inotify
-from . import event_properties, watch_properties
+from . import event_properties, watch_properties, decode_mask
+from .in_constants import _decode_mask
 import array
 import errno
 import fcntl
 import os
+import select
+import struct
 import termios
 
 
 
-def _make_getter(name, doc):
-    def getter(self, mask=constants['IN_' + name.upper()]):
-        return self.mask & mask
-    getter.__name__ = name
-    getter.__doc__ = doc
-    return getter
+def _add_flag_properties(cls, properties):
+    '''Add a read only attribute to cls for each name in properties that tests
+    the corresponding IN_* bit in the mask of an instance.'''
+    for name, doc in properties.items():
+        setattr(cls, name, inotify.maskflag(constants['IN_' + name.upper()], doc))
 
 
 
-class Event(object):
+class Event(inotify.event):
     '''Derived inotify event class.
 
     The following fields and properties are available:
@@ -66,16 +68,34 @@ class Event(object):
 
     wd: watch descriptor that triggered this event
 
+    raw: the underlying inotify event, with wd, mask, cookie and name
+    attributes. Events are _inotify.event objects themselves, so this is
+    the event itself.
+
+    Each flag is also available as a property, e.g. event.isdir. In
+    performance critical code, test the mask directly with
+    event.mask & inotify.IN_ISDIR or use event.has(inotify.IN_ISDIR).
+
+    Events can be handed back to their watcher with release() once they are
+    no longer needed, so that it can reuse them instead of allocating new
+    ones. This is optional.
     '''
 
+    # wd, mask, cookie and name are stored in the C base class, so Watcher.read
+    # can create events without running any python code.
     __slots__ = (
-        'cookie',
-        'mask',
-        'name',
-        'raw',
         'watch',
         )
 
+    def __new__(cls, raw, watch):
+        self = inotify.event.__new__(cls, *raw)
+        self.watch = watch
+        return self
+
+    @property
+    def raw(self):
+        return self
+
     @property
     def paths(self):
         if self.watch:
@@ -95,22 +115,37 @@ class Event(object):
 
     @property
     def mask_list(self):
-        return constants.decode_mask(self.mask)
-
-    def __init__(self, raw, watch):
-        self.raw = raw
-        self.watch = watch
-        self.mask = raw.mask
-        self.cookie = raw.cookie
-        self.name = raw.name
+        return decode_mask(self.mask)
+
+    def has(self, flags):
+        '''Return True if any of the given IN_* flags is set in the mask.'''
+        return bool(self.mask & flags)
+
+    def release(self):
+        '''Give this event back to the watcher that read it, to be reused for a
+        future event. Only call this if nothing refers to the event anymore,
+        as its contents will change.'''
+        watch = self.watch
+        self.watch = None
+        if watch is not None:
+            pool = watch._watcher._event_pool
+            if len(pool) < _event_pool_size:
+                pool.append(self)
     
     def __repr__(self):
-        r = repr(self.raw)
-        return ('Event(paths={}, ' + r[r.find('(')+1:]).format(repr(self.paths))
+        r = 'Event(paths={}, wd={}, mask={}'.format(
+            repr(self.paths), self.wd, '|'.join(_decode_mask(self.mask)))
+        if self.cookie:
+            r += ', cookie={:#x}'.format(self.cookie)
+        if self.name:
+            r += ', name={}'.format(repr(self.name))
+        return r + ')'
+
 
+_add_flag_properties(Event, event_properties)
 
-for name, doc in event_properties.items():
-    setattr(Event, name, property(_make_getter(name, doc), doc=doc))
+# The maximum number of released events a watcher keeps for reuse
+_event_pool_size = 4096
 
 
 class _Watch(object):
@@ -177,10 +212,78 @@ class _Watch(object):
         return '{}.Watch({}, {})'.format(__name__, self._watcher, self.wd)
 
 
-for name, doc in watch_properties.items():
-    setattr(_Watch, name, property(_make_getter(name, doc), doc=doc))
+_add_flag_properties(_Watch, watch_properties)
+
+
+
+_wakeup_value = struct.pack('=Q', 1)
+
+def _wakeup_fds():
+    '''Return a (readfd, writefd) pair of nonblocking file descriptors that
+    can be used to wake up a poll. This is an eventfd if available, else a
+    pipe.'''
+
+    if hasattr(os, 'eventfd'):
+        fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        return fd, fd
+    fds = os.pipe()
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fds
 
 
+class _Waker(object):
+    '''Waits until an inotify fd is readable, unless wake() is called.
+
+    Shared by Watcher and PathWatcher to make blocking reads
+    interruptible from another thread.'''
+
+    __slots__ = (
+        'fds',
+        'epoll',
+        'woken',
+        )
+
+    def __init__(self, fd):
+        self.fds = _wakeup_fds()
+        self.epoll = select.epoll()
+        self.epoll.register(fd, select.EPOLLIN)
+        self.epoll.register(self.fds[0], select.EPOLLIN)
+        # Set by wait() to show if the last wait was ended by wake()
+        self.woken = False
+
+    def wait(self):
+        '''Block until the inotify fd is readable or wake() is called. Return
+        False if woken up.'''
+
+        ready = [fd for fd, _ in self.epoll.poll()]
+        self.woken = self.fds[0] in ready
+        if self.woken:
+            self._drain()
+        return not self.woken
+
+    def wake(self):
+        try:
+            os.write(self.fds[1], _wakeup_value)
+        except OSError as err:
+            # The wakeup is already pending
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def _drain(self):
+        try:
+            while True:
+                os.read(self.fds[0], 4096)
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        self.epoll.close()
+        for fd in set(self.fds):
+            os.close(fd)
+
 
 class Watcher(object):
     '''Provide a Pythonic interface to the low-level inotify API.
@@ -188,14 +291,30 @@ class Watcher(object):
     Also adds derived information to each event that is not available
     through the normal inotify API, such as directory name.'''
 
-    def __init__(self):
-        '''Create a new inotify instance.'''
+    def __init__(self, strict_overflow=False):
+        '''Create a new inotify instance.
+
+        If strict_overflow is True, read() raises QueueOverflowException when
+        the kernel event queue overflowed and events were lost.'''
 
-        self.fd = inotify.init()
+        self.fd = inotify.init(inotify.IN_NONBLOCK | inotify.IN_CLOEXEC)
+        self.strict_overflow = strict_overflow
         # self._paths is managed from the Watch objects (except when the _Watch
         # object is finally removed).
         self._paths = {}
         self._watches = {}
+        # Reused by every read. EVENT_SIZE_MAX is the size of an inotify event
+        # with a name of NAME_MAX (255) bytes, so any event is guaranteed to
+        # fit.
+        self._readbuf = bytearray(64 * inotify.EVENT_SIZE_MAX)
+        # Events that were release()'d and can be reused
+        self._event_pool = []
+        self._events_read = 0
+        self._overflow_count = 0
+        self._iocbuf = array.array('i', [0])
+        # A blocking read waits on both the inotify fd and a wakeup fd, so
+        # that it can be interrupted from another thread with wake().
+        self._waker = _Waker(self.fd)
 
     def fileno(self):
         '''Return the file descriptor this watcher uses.
@@ -212,6 +331,36 @@ class Watcher(object):
         path = os.path.normpath(path)
         # The path may already be watched, so add in the mask.
         wd = inotify.add_watch(self.fd, path, mask | inotify.IN_MASK_ADD)
+        return self._register(wd, path, mask)
+
+    def add_many(self, paths_and_masks, onerror=None):
+        '''Add or modify watches for a sequence of (path, mask) pairs.
+
+        Return a list of the added or modified watches. Errors are raised
+        once all other watches have been added, unless optional arg
+        "onerror" is given. It is then called with an OSError instance
+        for each path that could not be watched.'''
+
+        paths_and_masks = [(os.path.normpath(path), mask)
+                           for path, mask in paths_and_masks]
+        results = inotify.add_watches(
+            self.fd, [(path, mask | inotify.IN_MASK_ADD)
+                      for path, mask in paths_and_masks])
+        watches = []
+        errors = []
+        for (path, mask), wd in zip(paths_and_masks, results):
+            if isinstance(wd, OSError):
+                errors.append(wd)
+            else:
+                watches.append(self._register(wd, path, mask))
+        for err in errors:
+            if onerror:
+                onerror(err)
+            else:
+                raise err
+        return watches
+
+    def _register(self, wd, path, mask):
         if not wd in self._watches:
             self._watches[wd] = _Watch(self, wd)
         watch = self._watches[wd]
@@ -246,24 +395,62 @@ class Watcher(object):
         '''Read a list of queued inotify events.
 
         If block is True (the default), block if no events are
-        available immediately. Else return an empty list if no events
-        are available.'''
+        available immediately. A blocking read can be interrupted with
+        wake(), in which case an empty list is returned. If block is False,
+        return an empty list if no events are available.'''
 
         if not len(self._watches):
             raise NoFilesException("There are no files to watch")
 
-        events = []
-        for evt in inotify.read(self.fd, block=block):
-            watch = None if evt.wd == -1 else self._watches[evt.wd]
-            event = Event(evt, watch)
-            events.append(event)
-            if event.ignored:
-                self._remove(event.watch.wd)
+        if block and not self._waker.wait():
+            return []
+
+        # Any events are available now, so this read never blocks. The
+        # events are created and looked up in C, only the ones that need
+        # further processing are handled here.
+        events, special = inotify.read_dispatch(
+            self.fd, Event, self._watches,
+            mask=inotify.IN_IGNORED | inotify.IN_Q_OVERFLOW,
+            pool=self._event_pool, block=False, buffer=self._readbuf)
+        overflowed = False
+        for event in special:
+            if event.mask & inotify.IN_IGNORED:
+                self._remove(event.wd)
+            else:
+                self._overflow_count += 1
+                overflowed = True
+        self._events_read += len(events)
+        if overflowed and self.strict_overflow:
+            raise QueueOverflowException("The inotify event queue overflowed", events)
         return events
 
+    def stats(self):
+        '''Return a (queue_bytes, overflow_count, events_read) tuple.
+
+        queue_bytes is the number of bytes of events waiting to be read,
+        overflow_count the number of times events were lost because the
+        kernel queue overflowed, and events_read the total number of events
+        read by this watcher.'''
+
+        fcntl.ioctl(self.fd, termios.FIONREAD, self._iocbuf, True)
+        return self._iocbuf[0], self._overflow_count, self._events_read
+
+    def wake(self):
+        '''Interrupt a blocking read() in another thread, which will return an
+        empty list. If no read is in progress, the next blocking read will
+        return immediately. Iteration over the watcher ends when it is
+        woken up, so this is also the way to stop a thread that iterates
+        over events.'''
+
+        self._waker.wake()
+
     def __iter__(self):
+        '''Iterate over events as they arrive, until wake() is called.'''
         while True:
-            for e in self.read():
+            events = self.read(block=True)
+            if not events and self._waker.woken:
+                return
+            for e in events:
                 yield e
 
     def close(self):
@@ -273,6 +460,7 @@ class Watcher(object):
 
         os.close(self.fd)
         self.fd = None
+        self._waker.close()
         self._paths.clear()
         self._watches.clear()
 
@@ -328,6 +516,14 @@ class Watcher(object):
 
         submask = mask | inotify.IN_ONLYDIR
 
+        def suberror(err):
+            if err.errno in self.ignored_errors:
+                return
+            if onerror:
+                onerror(err)
+            else:
+                raise err
+
         try:
             yield self.add(path, mask)
         except OSError as err:
@@ -336,16 +532,10 @@ class Watcher(object):
             else:
                 raise
         for root, dirs, names in os.walk(path, topdown=False, onerror=onerror):
-            for d in dirs:
-                try:
-                    yield self.add(root + '/' + d, submask)
-                except OSError as err:
-                    if err.errno in self.ignored_errors:
-                        continue
-                    if onerror:
-                        onerror(err)
-                    else:
-                        raise
+            # Add the watches for a whole directory in one call
+            for watch in self.add_many([(root + '/' + d, submask) for d in dirs],
+                                       onerror=suberror):
+                yield watch
 
     def add_all(self, path, mask, onerror=None):
         '''Add or modify watches over path and its subdirectories.
@@ -364,7 +554,7 @@ class Watcher(object):
 class AutoWatcher(Watcher):
     '''Watcher class that automatically watches newly created directories.'''
 
-    def __init__(self, addfilter=None):
+    def __init__(self, addfilter=None, strict_overflow=False):
         '''Create a new inotify instance.
 
         This instance will automatically watch newly created
@@ -374,13 +564,24 @@ class AutoWatcher(Watcher):
         callable that takes one parameter.  It will be called each time
         a directory is about to be automatically watched.  If it returns
         True, the directory will be watched if it still exists,
-        otherwise, it will be skipped.'''
+        otherwise, it will be skipped.
+
+        strict_overflow is passed on to Watcher.'''
 
-        super(AutoWatcher, self).__init__()
+        super(AutoWatcher, self).__init__(strict_overflow)
         self.addfilter = addfilter
 
     def read(self, block=False):
-        events = super(AutoWatcher, self).read(block)
+        try:
+            events = super(AutoWatcher, self).read(block)
+        except QueueOverflowException as err:
+            # Still watch the directories that were created in this batch
+            self._add_created(err.events)
+            raise
+        self._add_created(events)
+        return events
+
+    def _add_created(self, events):
         for evt in events:
             if evt.mask & inotify.IN_ISDIR and evt.mask & inotify.IN_CREATE:
                 if self.addfilter is None or self.addfilter(evt):
@@ -391,7 +592,6 @@ class AutoWatcher(Watcher):
                     except EnvironmentError as err:
                         if err.errno not in self.ignored_errors:
                             raise
-        return events
 
 
 class Threshold(object):
@@ -428,3 +628,12 @@ class Threshold(object):
 class NoFilesException (Exception):
     '''This inotify instance does not watch anything.'''
     pass
+
+
+class QueueOverflowException (Exception):
+    '''The kernel event queue overflowed, and events were lost. The events
+    that were read are available in the events attribute.'''
+
+    def __init__(self, msg, events):
+        Exception.__init__(self, msg)
+        self.events = events
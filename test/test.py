@@ -68,6 +68,8 @@ def test_open(w):
   assert ev1.open
   assert ev2.close
   assert ev2.close_nowrite
+  assert ev1.has(inotify.IN_OPEN) and not ev1.has(inotify.IN_CLOSE)
+  assert ev2.has(inotify.IN_OPEN | inotify.IN_CLOSE_NOWRITE)
   w.close()
 
 
@@ -185,3 +187,178 @@ def test_read_args(w):
 def test_kwarg(w):
   with pytest.raises(TypeError):
     inotify.inotify.read(w.fileno(), False)
+
+
+def test_wake(w):
+  w.add('testfile', inotify.IN_OPEN)
+  w.wake()
+  assert w.read() == []
+  open('testfile').close()
+  w.wake()
+  assert w.read() == []
+  ev, = w.read()
+  assert ev.open
+
+
+def test_read_buffer(w):
+  w.add('testfile', inotify.IN_OPEN | inotify.IN_CLOSE)
+  with pytest.raises(ValueError):
+    inotify.inotify.read(w.fileno(), block=False, buffer=bytearray(16))
+  # more events than fit in the buffer in one read() system call
+  for i in range(50):
+    open('testfile').close()
+  buf = bytearray(inotify.inotify.EVENT_SIZE_MAX)
+  evts = inotify.inotify.read(w.fileno(), block=False, buffer=buf)
+  assert len(evts) == 100
+  assert all(e.mask & inotify.IN_OPEN for e in evts[::2])
+
+
+def test_mask_list(w):
+  w.add('testfile', inotify.IN_OPEN)
+  open('testfile').close()
+  ev, = w.read(block=False)
+  assert ev.mask_list == ['IN_OPEN']
+  assert inotify.decode_mask(inotify.IN_OPEN | inotify.IN_ISDIR) == ['IN_OPEN', 'IN_ISDIR']
+
+
+def test_release(w):
+  w.add('testfile', inotify.IN_OPEN | inotify.IN_CLOSE)
+  open('testfile').close()
+  ev1, ev2 = w.read(block=False)
+  ev1.release()
+  open('testfile').close()
+  ev3, ev4 = w.read(block=False)
+  assert ev3 is ev1
+  assert ev3.open and ev3.fullpath == 'testfile'
+  assert ev4 is not ev2 and ev4.close
+
+
+def test_event_type():
+  ev = inotify.inotify.event(1, inotify.IN_MOVED_TO, 7, 'name')
+  assert (ev.wd, ev.mask, ev.cookie, ev.name) == (1, inotify.IN_MOVED_TO, 7, 'name')
+  assert repr(ev) == "event(wd=1, mask=IN_MOVED_TO, cookie=0x7, name='name')"
+  with pytest.raises(TypeError):
+    inotify.inotify.event('x', 1)
+  with pytest.raises(TypeError):
+    inotify.inotify.event(1, 1, 'cookie')
+
+
+def test_read_batch(w):
+  w.add('.', inotify.IN_CREATE | inotify.IN_MOVE)
+  os.rename('testfile', 'targetfile')
+  (wd1, mask1, cookie1, name1), (wd2, mask2, cookie2, name2) = \
+      inotify.inotify.read_batch(w.fileno(), block=False)
+  assert wd1 == wd2 == w.get_watch('.').wd
+  assert mask1 == inotify.IN_MOVED_FROM and name1 == 'testfile'
+  assert mask2 == inotify.IN_MOVED_TO and name2 == 'targetfile'
+  assert cookie1 and cookie1 == cookie2
+  open('newfile', 'w').close()
+  ev, = w.read(block=False)
+  assert ev.raw.wd == ev.wd and ev.raw.mask == inotify.IN_CREATE
+  assert ev.raw.cookie is None and ev.raw.name == 'newfile'
+
+
+def test_stats(w):
+  w.add('testfile', inotify.IN_OPEN | inotify.IN_CLOSE)
+  assert w.stats() == (0, 0, 0)
+  open('testfile').close()
+  queued, overflows, nread = w.stats()
+  assert queued > 0 and overflows == nread == 0
+  w.read(block=False)
+  assert w.stats() == (0, 0, 2)
+
+
+def test_overflow():
+  w = watcher.Watcher(strict_overflow=True)
+  w.add('testfile', inotify.IN_OPEN | inotify.IN_CLOSE)
+  for i in range(inotify.max_queued_events() // 2 + 1):
+    open('testfile').close()
+  with pytest.raises(inotify.QueueOverflowException) as excinfo:
+    w.read(block=False)
+  assert excinfo.value.events[-1].q_overflow
+  assert w.stats()[1] == 1
+  w.close()
+
+
+def test_overflow_autowatch():
+  w = watcher.AutoWatcher(strict_overflow=True)
+  w.add('.', inotify.IN_CREATE | inotify.IN_OPEN | inotify.IN_CLOSE)
+  os.mkdir('newdir')
+  for i in range(inotify.max_queued_events() // 2 + 1):
+    open('testfile').close()
+  with pytest.raises(inotify.QueueOverflowException) as excinfo:
+    w.read(block=False)
+  assert excinfo.value.events[0].create and excinfo.value.events[0].isdir
+  # the new directory is watched even though read() raised
+  assert 'newdir' in w.paths()
+  w.close()
+
+
+def test_read_dispatch(w):
+  watch = w.add('testfile', inotify.IN_OPEN | inotify.IN_CLOSE)
+  open('testfile').close()
+  evts, matched = inotify.inotify.read_dispatch(w.fileno(), lambda raw, wt: (raw[1], wt),
+      {watch.wd: 'watch'}, mask=inotify.IN_CLOSE, block=False)
+  assert evts == [(inotify.IN_OPEN, 'watch'), (inotify.IN_CLOSE_NOWRITE, 'watch')]
+  assert matched == evts[1:]
+  open('testfile').close()
+  evts, matched = inotify.inotify.read_dispatch(w.fileno(), lambda raw, wt: wt, {}, block=False)
+  assert evts == [None, None] and matched == []
+
+
+def test_nonblocking_fd(w):
+  import fcntl, threading
+  assert fcntl.fcntl(w.fileno(), fcntl.F_GETFL) & os.O_NONBLOCK
+  assert fcntl.fcntl(w.fileno(), fcntl.F_GETFD) & fcntl.FD_CLOEXEC
+  w.add('testfile', inotify.IN_OPEN)
+  # the low level read() still blocks on a nonblocking fd
+  t = threading.Timer(0.05, lambda: open('testfile').close())
+  t.start()
+  evts = inotify.inotify.read(w.fileno())
+  t.join()
+  assert len(evts) == 1 and evts[0].mask & inotify.IN_OPEN
+
+
+def test_add_many(w):
+  watches = w.add_many([('testfile', inotify.IN_OPEN), ('testdir/', inotify.IN_CREATE)])
+  assert [wt.paths for wt in watches] == [{'testfile'}, {'testdir'}]
+  assert w.num_watches() == 2
+  with pytest.raises(OSError):
+    w.add_many([('nonexistant', inotify.IN_OPEN), ('testfile', inotify.IN_CLOSE)])
+  # the valid entry is still added
+  assert w.get_watch('testfile').mask & inotify.IN_CLOSE
+  errors = []
+  assert w.add_many([('nonexistant', inotify.IN_OPEN)], onerror=errors.append) == []
+  assert len(errors) == 1 and errors[0].filename == 'nonexistant'
+  with pytest.raises(TypeError):
+    inotify.inotify.add_watches(w.fileno(), [['testfile', inotify.IN_OPEN]])
+  with pytest.raises(TypeError):
+    inotify.inotify.add_watches(w.fileno(), [('testfile',)])
+
+
+def test_wake_thread(w):
+  import threading
+  w.add('testfile', inotify.IN_OPEN)
+  t = threading.Timer(0.05, w.wake)
+  t.start()
+  assert w.read() == []
+  t.join()
+
+
+def test_iter_wake(w):
+  import threading
+  w.add('testfile', inotify.IN_OPEN)
+  open('testfile').close()
+  events = []
+  received = threading.Event()
+  def consume():
+    for e in w:
+      events.append(e)
+      received.set()
+  t = threading.Thread(target=consume)
+  t.start()
+  assert received.wait(5)
+  w.wake()
+  t.join(5)
+  assert not t.is_alive()
+  assert len(events) == 1 and events[0].open
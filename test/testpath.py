@@ -154,7 +154,7 @@ def test_open(w):
 
   link2 = watch.links[1]
   assert link2.idx == 1
-  assert link2.path == str(P.cwd()['testfile'])
+  assert link2.path == str(P.cwd() / 'testfile')
   assert link2.rest == '.'
   assert link2.mask == IN_OPEN | IN_CLOSE
   assert link2.watch == watch
@@ -228,7 +228,7 @@ def test_linkchange(w):
 def test_multi(w):
   open('file2', 'w').close()
   os.symlink('file2', 'link2')
-  os.symlink(str(P.cwd()['link2']), 'link3')
+  os.symlink(str(P.cwd() / 'link2'), 'link3')
   os.symlink('testfile', 'link4')
   
   w.add('link3', IN_OPEN)
@@ -300,6 +300,30 @@ def test_delete(w):
     assert ev3.path_delete
     assert len(w.watches()) == 1
 
+def test_pop_event(w):
+    w.add('testfile', IN_OPEN | IN_CLOSE)
+    assert w.pop_event(block=False) is None
+    open('testfile').close()
+    open('testfile').close()
+    assert w.pop_event().open
+    assert w.pop_event().close_nowrite
+    # read() returns the remaining events, pop_event() then reads new ones
+    ev1, ev2 = w.read()
+    assert ev1.open and ev2.close_nowrite
+    open('testfile').close()
+    assert w.pop_event().open
+    ev, = w.read()
+    assert ev.close_nowrite
+    assert w.pop_event(block=False) is None
+
+def test_pop_event_ignored(w):
+    w.add('testfile', IN_OPEN)
+    w.add('testdir', IN_OPEN)
+    w.remove('testfile')
+    # the IN_IGNORED for testfile produces no event
+    assert w.pop_event() is None
+    assert len(w.watches()) == 1
+
 def test_wrongpath(w):
     w.add('nonexistant', IN_OPEN)
     assert w.read(block=False) == []
@@ -308,4 +332,48 @@ def test_wrongpath(w):
     ev1 = evts[0]
     assert ev1.path_create
 
-
+def test_chdir(w):
+    open('testdir/testfile', 'w').close()
+    os.chdir('testdir')
+    w.add('testfile', IN_OPEN)
+    os.chdir('..')
+    # the watch remembers the working directory at the time of add()
+    open('testdir/testfile').close()
+    ev, = w.read(0)
+    assert ev.open and ev.path == 'testfile'
+    open('testfile').close()
+    assert w.read(0) == []
+
+def test_pathexceptions():
+    e = inotify.FileNotFoundError('nonexistant')
+    assert e.errno == errno.ENOENT and e.filename == 'nonexistant'
+    assert 'does not exist' in str(e)
+    e = inotify.NotADirectoryError('testfile')
+    assert e.errno == errno.ENOTDIR
+
+def test_wake(w):
+    w.add('testfile', IN_OPEN)
+    w.wake()
+    assert w.read() == []
+    open('testfile').close()
+    w.wake()
+    assert w.pop_event() is None
+    assert w.pop_event().open
+
+def test_iter_wake(w):
+    import threading
+    w.add('testfile', IN_OPEN)
+    open('testfile').close()
+    events = []
+    received = threading.Event()
+    def consume():
+        for e in w:
+            events.append(e)
+            received.set()
+    t = threading.Thread(target=consume)
+    t.start()
+    assert received.wait(5)
+    w.wake()
+    t.join(5)
+    assert not t.is_alive()
+    assert len(events) == 1 and events[0].open